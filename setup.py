@@ -10,7 +10,8 @@ import numpy as np
 
 def get_extensions():
     extensions = [Extension('*', sources=['src/wwvec/basin_vectorization/components.pyx']),
-                  Extension('*', sources=['src/wwvec/basin_vectorization/thin_grid.pyx'])]
+                  Extension('*', sources=['src/wwvec/basin_vectorization/thin_grid.pyx']),
+                  Extension('*', sources=['src/wwvec/basin_vectorization/cell_lists.pyx'])]
     return extensions
 
 
@@ -0,0 +1,98 @@
+#cython: language_level=3
+import cython as c
+import numpy as np
+cimport numpy as cnp
+cnp.import_array()
+ctypedef cnp.uint8_t npuint8
+ctypedef cnp.int16_t npint16
+ctypedef cnp.int32_t npint
+
+# The order in which the neighbors of a cell are investigated, and for each neighbor the index of the opposite
+# direction (so the direction from the neighbor back to the cell).
+cdef int[8] ROW_SHIFTS = [1, -1, 0, 0, 1, -1, 1, -1]
+cdef int[8] COL_SHIFTS = [0, 0, 1, -1, 1, 1, -1, -1]
+cdef int[8] OPPOSITE_DIRECTIONS = [1, 0, 3, 2, 7, 6, 5, 4]
+
+
+def investigate_row_col(
+        int row,
+        int col,
+        cnp.ndarray[npint16, ndim=2] count_grid,
+        cnp.ndarray[npint16, ndim=2] init_count_grid,
+        cnp.ndarray[npuint8, ndim=2] connections_seen,
+        bint investigate_all,
+        cnp.ndarray[npint, ndim=2] cell_buffer,
+        cnp.ndarray[npint, ndim=2] count_1_buffer
+):
+    """
+    Investigates a cell, then investigates any adjacent cells under appropriate conditions. Cells in the middle of a
+    waterway (cells whose initial count is 2) are followed until the end of the waterway, unless investigate_all is
+    True.
+
+    Parameters
+    ----------
+    row : int
+        The row of the cell to start at.
+    col : int
+        The column of the cell to start at.
+    count_grid : np.ndarray[np.int16, ndim=2]
+        The number of neighboring waterway cells that haven't been investigated yet, updated in place.
+    init_count_grid : np.ndarray[np.int16, ndim=2]
+        The initial number of neighboring waterway cells.
+    connections_seen : np.ndarray[np.uint8, ndim=2]
+        Bit k of connections_seen[row, col] is set if the connection from (row, col) to its k-th neighbor has been
+         seen, updated in place. Used so that we don't turn around while investigating a cell.
+    investigate_all : bool
+        If True, only the first adjacent cell is investigated.
+    cell_buffer : np.ndarray[np.int32, ndim=2]
+        A (n, 2) array the investigated cells are written to, n must be at least the number of connections left.
+    count_1_buffer : np.ndarray[np.int32, ndim=2]
+        A (2*n + 2, 2) array the cells whose count drops to 1 are written to.
+
+    Returns
+    -------
+    tuple
+        A tuple containing the following elements:
+        - num_cells : int
+            The number of cells written to cell_buffer, or -1 if no cells were written and the last cell of the
+            cell list should be removed.
+        - num_count_1 : int
+            The number of cells written to count_1_buffer.
+    """
+    cdef int num_cells = 0
+    cdef int num_count_1 = 0
+    cdef int row_1
+    cdef int col_1
+    cdef int k
+    cdef bint found
+    while True:
+        count_grid[row, col] -= 1
+        if count_grid[row, col] == 1:
+            count_1_buffer[num_count_1, 0] = row
+            count_1_buffer[num_count_1, 1] = col
+            num_count_1 += 1
+        found = False
+        for k in range(8):
+            row_1 = row + ROW_SHIFTS[k]
+            col_1 = col + COL_SHIFTS[k]
+            if count_grid[row_1, col_1] > 0 and not (connections_seen[row, col] >> k) & 1:
+                connections_seen[row, col] |= 1 << k
+                connections_seen[row_1, col_1] |= 1 << OPPOSITE_DIRECTIONS[k]
+                count_grid[row_1, col_1] -= 1
+                if count_grid[row_1, col_1] == 1:
+                    count_1_buffer[num_count_1, 0] = row_1
+                    count_1_buffer[num_count_1, 1] = col_1
+                    num_count_1 += 1
+                cell_buffer[num_cells, 0] = row_1
+                cell_buffer[num_cells, 1] = col_1
+                num_cells += 1
+                found = True
+                break
+        if not found:
+            # In this case there is only one cell in the list, so we can't make a line string from it. This can
+            # occur if the cell boarders the reference waterways, but no other model waterways cells.
+            return num_cells - 1, num_count_1
+        if investigate_all or init_count_grid[row_1, col_1] != 2:
+            return num_cells, num_count_1
+        row = row_1
+        col = col_1
@@ -1,9 +1,19 @@
-import networkx as nx
 import numpy as np
+import pandas as pd
+from scipy.ndimage import convolve
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from wwvec.basin_vectorization.basin_data_class import BasinData
 from collections import defaultdict
 from functools import cached_property
 
+# The (row, col) shifts to the 8 neighbors of a cell, edge weights are stored in this order.
+NEIGHBOR_SHIFTS = [(row_shift, col_shift) for row_shift in (-1, 0, 1) for col_shift in (-1, 0, 1)
+                   if row_shift != 0 or col_shift != 0]
+# The number of rows handled at a time when building the edge weights and the graph, so the slices of the grids being
+# worked on stay in cache.
+ROW_BLOCK_SIZE = 64
+
 
 class Connector:
     """
@@ -20,18 +30,27 @@ class Connector:
                                     an edge in the graph. Defaults to 25.
         num_rows (int): The number of rows in the basin grid.
         num_cols (int): The number of columns in the basin grid.
-        nodes (set): A set of nodes forming the graph.
+        nodes_grid (ndarray): A boolean mask of the cells that are nodes in the graph.
+        nodes (ndarray): The int32 linear indices row*num_cols + col of the nodes, node i of the graph is the cell
+                          divmod(nodes[i], num_cols).
+        node_ids (ndarray): The inverse of nodes, node_ids[row*num_cols + col] is the id of the node (row, col) in
+                             the graph, or -1 if the cell isn't a node.
         elevation_grid (ndarray): The elevation grid of the basin.
-        weight_grid (ndarray): The weight grid of the basin.
-        component_grid (ndarray): The component grid of the basin.
+        weight_grid (ndarray): The weight grid of the basin, this is basin_data.weight_grid and is modified in place
+                                by get_paths (copy it beforehand if the original weights are needed).
+        component_grid (ndarray): The component grid of the basin, this is basin_data.component_grid and is modified
+                                   in place by get_paths.
         main_component (int): The main component of the basin.
-        graph (nx.DiGraph): The graph representation of the basin.
+        edge_weights (ndarray): The (8, num_rows, num_cols) array of edge weights, edge_weights[k, row, col] is the
+                                 weight of the edge from (row, col) to its NEIGHBOR_SHIFTS[k] neighbor.
 
     Methods:
         get_component_min_elevation_points(): Returns the minimum elevation points for each component in the basin.
         get_paths(cut_offs): Finds the shortest paths from disconnected components to the main component.
-        get_weight(node1, node2): Computes the weight of an edge between two nodes.
-        add_edges_to_graph(nodes_list): Adds edges to the graph based on the nodes list.
+        get_target_paths(sources, targets, cutoff): Finds the shortest paths from the sources to each target.
+        make_graph(): Makes the sparse adjacency matrix of the graph from the edge weights, a block of rows at a time.
+        make_edge_weights(row_start, row_end): Computes the edge weights for the nodes in a block of rows.
+        update_edge_weights(rows): Recomputes the edge weights for the nodes in the given rows.
 
     """
     def __init__(self, basin_data: BasinData, min_probability=None, max_elevation_diff: int = 20,):
@@ -41,13 +60,18 @@ class Connector:
         self.min_probability = min_probability
         self.max_elevation_diff = max_elevation_diff
         self.num_rows, self.num_cols = basin_data.component_grid.shape
-        self.elevation_grid = basin_data.elevation_grid.astype(np.float32)
+        self.elevation_grid = np.ascontiguousarray(basin_data.elevation_grid, dtype=np.float32)
         self.weight_grid = basin_data.weight_grid
         self.component_grid = basin_data.component_grid
         self.nodes_grid = (self.probability_grid > min_probability) | (self.component_grid > 0)
+        self.nodes = np.flatnonzero(self.nodes_grid).astype(np.int32)
+        self.node_ids = np.full(self.num_rows*self.num_cols, -1, dtype=np.int32)
+        self.node_ids[self.nodes] = np.arange(len(self.nodes), dtype=np.int32)
         self.main_component = basin_data.main_component
-        self.graph = nx.DiGraph()
-        self.add_edges_to_graph()
+        self.edge_weights = np.empty((len(NEIGHBOR_SHIFTS), self.num_rows, self.num_cols), dtype=np.float32)
+        for row_start in range(0, self.num_rows, ROW_BLOCK_SIZE):
+            row_end = min(row_start + ROW_BLOCK_SIZE, self.num_rows)
+            self.edge_weights[:, row_start:row_end] = self.make_edge_weights(row_start, row_end)
 
     @cached_property
     def component_information(self):
@@ -55,13 +79,24 @@ class Connector:
         component_information = defaultdict(
             lambda: {'nodes': [], 'min_elevation': np.inf, 'min_elevation_node': (-1, -1)}
         )
-        for (row, col) in zip(rows, cols):
-            component = self.component_grid[row, col]
-            component_information[component]['nodes'].append((row, col))
-            elevation = self.elevation_grid[row-1: row+2, col-1: col+2].mean()
-            if elevation < component_information[component]['min_elevation']:
-                component_information[component]['min_elevation'] = elevation
-                component_information[component]['min_elevation_node'] = (row, col)
+        # The elevation of a cell is the mean of elevation_grid[row-1: row+2, col-1: col+2], so on the last row and
+        # column the window is cut off by the grid. The window sums are exact for integer elevations, so these means
+        # match the per cell means.
+        window = np.ones((3, 3), dtype=self.elevation_grid.dtype)
+        window_sums = convolve(self.elevation_grid, window, mode='constant')
+        window_sizes = convolve(np.ones_like(self.elevation_grid), window, mode='constant')
+        elevation_means = (window_sums/window_sizes)[rows, cols]
+        # On the first row and column row-1 or col-1 is -1, so the window is empty and the cell is never the minimum.
+        elevation_means[(rows == 0) | (cols == 0)] = np.inf
+        components = pd.DataFrame({'component': self.component_grid[rows, cols], 'elevation': elevation_means})
+        component_groups = components.groupby('component')
+        min_elevation_indices = component_groups['elevation'].idxmin()
+        for component, indices in component_groups.indices.items():
+            min_index = min_elevation_indices[component]
+            component_information[component]['nodes'] = list(zip(rows[indices].tolist(), cols[indices].tolist()))
+            if elevation_means[min_index] < np.inf:
+                component_information[component]['min_elevation'] = elevation_means[min_index]
+                component_information[component]['min_elevation_node'] = (rows[min_index], cols[min_index])
         return component_information
 
     def get_paths(self, cut_offs: list = (8, 32, 400)):
@@ -87,7 +122,6 @@ class Connector:
 
         """
         sources = self.component_information[self.main_component]['nodes']
-        self.graph.add_nodes_from(sources)
         targets = [
             component_info['min_elevation_node'] for (component, component_info) in self.component_information.items()
             if component != self.main_component
@@ -96,10 +130,8 @@ class Connector:
         components_seen = {self.main_component}
         paths_to_return = {}
         for i, cutoff in enumerate(cut_offs):
-            paths = nx.multi_source_dijkstra_path(
-                G=self.graph, sources=sources, cutoff=cutoff
-            )
-            target_paths = [(target, paths.get(target, [])) for target in targets]
+            changed_rows = set()
+            target_paths = self.get_target_paths(sources=sources, targets=targets, cutoff=cutoff)
             target_paths.sort(key=lambda x: len(x[1]))
             for target, path in target_paths:
                 if len(path) > 0:
@@ -114,7 +146,7 @@ class Connector:
                                 self.component_information[new_component]['nodes'].append((row, col))
                             self.weight_grid[row, col] = 0
                             self.component_grid[row, col] = new_component
-                            self.update_weight((row, col))
+                            changed_rows.add(row)
                         else:
                             break
                     paths_to_return[target] = {'path': path_to_save, 'i': i+3}
@@ -123,80 +155,130 @@ class Connector:
                     targets.remove(target)
             if len(targets) == 0:
                 break
+            self.update_edge_weights(changed_rows)
         return paths_to_return, init_targets, components_seen
 
-    def update_weight(self, node):
-        for other_node in self.graph.adj[node]:
-            new_weight_1 = self.get_weight(node, other_node)
-            self.graph.adj[node][other_node]['weight'] = new_weight_1
-            new_weight_2 = self.get_weight(other_node, node)
-            self.graph.adj[other_node][node]['weight'] = new_weight_2
-
-
-    def get_weight(
-            self, node_t, node_s,
-            *args, **kwargs
-    ):
+    def get_target_paths(self, sources: list, targets: list, cutoff: float) -> list:
         """
         Parameters
         ----------
-        node_t: Tuple[int, int]
-            The coordinates of the target node.
+        sources : list
+            List of (row, col) source nodes.
+        targets : list
+            List of (row, col) target nodes.
+        cutoff : float
+            Targets whose distance from the sources is larger than cutoff are not reached.
+
+        Returns
+        -------
+        list
+            A list of (target, path) pairs, where path is the list of (row, col) nodes from a source to the target,
+            or an empty list if the target was not reached.
+
+        """
+        sources = np.array(sources, dtype=np.int32).reshape(-1, 2)
+        sources = self.node_ids[sources[:, 0]*self.num_cols + sources[:, 1]]
+        distances, predecessors, _ = dijkstra(
+            self.make_graph(), indices=sources[sources >= 0], return_predecessors=True, limit=cutoff, min_only=True
+        )
+        target_paths = []
+        for target in targets:
+            path = []
+            # A component with no min elevation node has the target (-1, -1), which is never reached.
+            node = self.node_ids[target[0]*self.num_cols + target[1]] if min(target) >= 0 else -1
+            if node >= 0 and distances[node] <= cutoff:
+                while node >= 0:
+                    path.append(divmod(int(self.nodes[node]), self.num_cols))
+                    node = predecessors[node]
+                path.reverse()
+            target_paths.append((target, path))
+        return target_paths
 
-        node_s: Tuple[int, int]
-            The coordinates of the source node.
+    def make_graph(self) -> csr_matrix:
+        """
+        Returns
+        -------
+        csr_matrix
+            The (len(nodes), len(nodes)) adjacency matrix of the graph, where the node (row, col) has index
+            node_ids[row*num_cols + col]. Edges with a weight of 0 are kept as explicit zeros.
 
-        *args
-            Variable length positional arguments.
+        """
+        num_nodes = len(self.nodes)
+        from_nodes = []
+        to_nodes = []
+        weights = []
+        for row_start in range(0, self.num_rows, ROW_BLOCK_SIZE):
+            row_end = min(row_start + ROW_BLOCK_SIZE, self.num_rows)
+            for k, (row_shift, col_shift) in enumerate(NEIGHBOR_SHIFTS):
+                edge_weights = self.edge_weights[k, row_start:row_end].ravel()
+                nodes = np.flatnonzero(np.isfinite(edge_weights))
+                weights.append(edge_weights[nodes])
+                nodes += row_start*self.num_cols
+                from_nodes.append(self.node_ids[nodes])
+                to_nodes.append(self.node_ids[nodes + row_shift*self.num_cols + col_shift])
+        graph = csr_matrix(
+            (np.concatenate(weights), (np.concatenate(from_nodes), np.concatenate(to_nodes))),
+            shape=(num_nodes, num_nodes)
+        )
+        return graph
 
-        **kwargs
-            Variable length keyword arguments.
+    def make_edge_weights(self, row_start: int = 0, row_end: int = None) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        row_start : int, optional
+            The first row of the block. Defaults to 0.
+        row_end : int, optional
+            The row after the last row of the block. Defaults to num_rows.
 
         Returns
         -------
-        float
-            The weight of the edge between the two nodes.
+        ndarray
+            The (8, row_end - row_start, num_cols) float32 array of edge weights for the nodes in the block of rows.
+            Entry [k, row, col] is the weight of the edge from (row_start + row, col) to its NEIGHBOR_SHIFTS[k]
+            neighbor, or np.inf if there is no such edge.
 
         """
-        row_t, col_t = node_t
-        row_s, col_s = node_s
-        elevation1 = self.elevation_grid[row_t, col_t]
-        elevation2 = self.elevation_grid[row_s, col_s]
-        elevation_diff = max(0, elevation1 - elevation2)
-        weight = self.weight_grid[row_t, col_t]
-        # If the elevation difference is too large, then we don't want to use the edge at all,
-        # if the elevation is 0, then we will defer to how well the model did there,
-        # and in the final case, we scale the elevation_diff by weight if that increases the weight.
-        if elevation_diff > self.max_elevation_diff:
+        row_end = self.num_rows if row_end is None else row_end
+        edge_weights = np.full((len(NEIGHBOR_SHIFTS), row_end - row_start, self.num_cols), np.inf, dtype=np.float32)
+        for k, (row_shift, col_shift) in enumerate(NEIGHBOR_SHIFTS):
+            # The rows and cols of the nodes in the block whose neighbor is in the grid, and the rows and cols of those
+            # neighbors.
+            rows = slice(max(row_start, -row_shift), min(row_end, self.num_rows - row_shift))
+            cols = slice(max(0, -col_shift), min(self.num_cols, self.num_cols - col_shift))
+            neighbor_rows = slice(rows.start + row_shift, rows.stop + row_shift)
+            neighbor_cols = slice(cols.start + col_shift, cols.stop + col_shift)
+            elevation_diff = self.elevation_grid[rows, cols] - self.elevation_grid[neighbor_rows, neighbor_cols]
+            elevation_diff = np.maximum(elevation_diff, 0)
+            weight = self.weight_grid[rows, cols]
+            # If the elevation difference is too large, then we don't want to use the edge at all,
+            # if the elevation is 0, then we will defer to how well the model did there,
+            # and in the final case, we scale the elevation_diff by weight if that increases the weight.
             # The Idea is that our DEM isn't terrible, so water likely shouldn't gain too much elevation,
-            # we set that at 20 meters.
-            elevation_diff = 1e30
-        if elevation_diff == 0:
-            # The idea is that if we have a bunch of cells all with a zero elevation difference,
-            # then we should use whichever cells the model was most certain about
-            return max(weight, 0)
-        else:
-            # Similarly, we scale the elevation difference up where the model is less certain, but
-            # we never scale the elevation difference down. We don't scale the elevation difference down
-            # to avoid the graph from searching upstream along cells where the scaled model outputs are 1
-            # for a nearby connection
-            return max(weight * elevation_diff, elevation_diff)
-
-    def check_row_col(self, row, col):
-        return self.nodes_grid[row, col]
-
-    def add_edges_to_graph(self, nodes_list=None):
+            # and that if we have a bunch of cells all with a zero elevation difference, then we should use whichever
+            # cells the model was most certain about. Similarly, we scale the elevation difference up where the model
+            # is less certain, but we never scale the elevation difference down. We don't scale the elevation
+            # difference down to avoid the graph from searching upstream along cells where the scaled model outputs
+            # are 1 for a nearby connection.
+            block_rows = slice(rows.start - row_start, rows.stop - row_start)
+            block_weights = edge_weights[k, block_rows, cols]
+            np.multiply(weight, elevation_diff, out=block_weights)
+            np.maximum(block_weights, elevation_diff, out=block_weights)
+            is_flat = elevation_diff == 0
+            block_weights[is_flat] = np.maximum(weight[is_flat], 0)
+            is_edge = self.nodes_grid[rows, cols] & self.nodes_grid[neighbor_rows, neighbor_cols]
+            is_edge &= elevation_diff <= self.max_elevation_diff
+            block_weights[~is_edge] = np.inf
+        return edge_weights
+
+    def update_edge_weights(self, rows) -> None:
         """
         Parameters
         ----------
-        nodes_list : list, optional
-            List of nodes to be added as edges to the graph. If not provided, it will use the nodes list of the graph.
+        rows : iterable
+            The rows whose weights in weight_grid have changed, the weights of the edges leaving those rows are
+            recomputed.
 
         """
-        if nodes_list is None:
-            nodes_list = [(row, col) for row in range(self.num_rows) for col in range(self.num_cols)]
-        indices = [-1, 0, 1]
-        edges = [[(row, col), (row+i, col+j), self.get_weight((row, col), (row+i, col+j))]
-                 for (row, col) in nodes_list for i in indices for j in indices
-                 if self.check_row_col(row, col) and self.check_row_col(row+i, col+j) and (i != 0 or j != 0)]
-        self.graph.add_weighted_edges_from(edges)
+        for row in rows:
+            self.edge_weights[:, row:row+1] = self.make_edge_weights(row, row+1)
@@ -1,15 +1,11 @@
 import shapely
 import numpy as np
-import sys
 import geopandas as gpd
 import pandas as pd
 from functools import cached_property
+from scipy.ndimage import convolve, maximum_filter
 from wwvec.basin_vectorization.basin_data_class import BasinData
-from collections import defaultdict
-
-# The investigate_row_col method is called recursively, and the lines can get pretty long. In the long run, it might
-# be better to rewrite that function as a loop.
-sys.setrecursionlimit(100000000)
+from wwvec.basin_vectorization.cell_lists import investigate_row_col
 
 
 # We generally want to make all waterway segments up to intersections (so a waterway only intersects another waterway at
@@ -29,23 +25,33 @@ class Vectorizer:
             y_res (float): The y resolution of the basin data.
             reference_waterway_data (list):
                 A list of shapely LineString objects representing the reference waterway data.
-            thin_grid (np.ndarray): The thin grid representation of the waterways data.
-            connecting_points_coordinates (set): The set of coordinates for all cells that border the tdx waterways.
-            list_of_cell_lists (list): A list of cell lists.
+            thin_grid (np.ndarray): The thin grid representation of the waterways data, with all cells labeled as 2
+                assigned a value of 0 (a view of the interior of clean_embed).
+            connecting_points_coordinates (np.ndarray):
+                The sorted coordinates for all cells that border the tdx waterways, as complex numbers x + y*1j.
+            cell_buffer (np.ndarray): An (n, 2) array holding the (row, col) cells of every cell list back to back.
+            cell_buffer_end (int): The index in cell_buffer after the last cell written.
+            line_offsets (list): Cell list i is cell_buffer[line_offsets[i]:line_offsets[i+1]], the last offset is the
+                start of the cell list currently being made.
             line_strings (list): A list of shapely LineString objects representing the waterways.
             intersection_points (list): A list of intersection points between the waterways and the tdx waterways.
-            connections_seen (defaultdict): A defaultdict that keeps track of the connections seen between waterways.
+            connections_seen (np.ndarray): A uint8 array that keeps track of the connections seen between waterways
+                cells in the embedded grid, bit k of a cell is set once the connection to its k-th neighbor is seen.
             clean_embed (np.ndarray): The copy of the thin grid with all cells labeled as 2 assigned a value of 0.
             count_grid (np.ndarray): A grid whose cells are the number of neighboring cells that are waterways.
             init_count_copy (np.ndarray): A copy of the count grid.
             init_count_grid (np.ndarray): A copy of the count grid.
+            count_1_buffer (np.ndarray): The array cells whose count drops to 1 are written to while investigating.
+            count_1_cells (list): The cells whose count has dropped to 1 since they were last checked.
             new_linestrings (list): A list of new line strings representing the waterways.
 
         Methods:
             reference_waterway_points() -> list:
                 Returns a list of shapely Point objects representing the reference waterway points.
-            make_connecting_points_coordinates() -> set:
-                Make the set of coordinates for all cells that border the tdx waterways.
+            make_connecting_points_coordinates() -> np.ndarray:
+                Make the sorted coordinates for all cells that border the tdx waterways.
+            coordinates_to_complex(coordinates: np.ndarray) -> np.ndarray:
+                Converts an (n, 2) array of coordinates to n complex numbers, so coordinates can be compared with np.isin.
             connecting_lines() -> list:
                 Makes a list of linestrings connecting the model's linestrings to the tdx linestrings.
             make_the_line_string_gdf() -> None:
@@ -53,21 +59,25 @@ class Vectorizer:
                  the other is the geometry column.
             connect_to_base_waterways() -> None:
                 Determines the points for the model's waterways which will be connected to the tdx-waterways.
-            embed_in_larger(grid: np.ndarray, side_increase: int) -> np.ndarray:
+            embed_in_larger(grid: np.ndarray, side_increase: int, where: np.ndarray=None) -> np.ndarray:
                 Embeds the grid in a larger grid for convenience.
             make_count_8_grid(grid: np.ndarray) -> np.ndarray:
                 Makes a grid whose cells are the number of neighboring cells that are waterways.
             make_all_cell_lists() -> None:
-                Updates list_of_cell_lists which will be used to make line strings.
+                Updates the cell lists which will be used to make line strings.
             add_remaining_cell_lists() -> None:
                 Check and add all cells that haven't been fully investigated yet.
             make_all_cell_lists_starting_at_1(investigate_all: bool=False) -> None:
                 Investigate all cells that border only one other cell (these should be sources or targets of waterways).
             make_all_cell_lists_starting_at_2(investigate_all: bool=False) -> None:
                 Investigate all cells that boarder two other cells (so somewhere in the middle of a waterway)
-            add_to_connections_seen(node1, node2):
-                A dictionary that keeps track of the connections seen.
-            investigate_row_col(row, col, cell_list, investigate_all: bool=False) -> None:
+            start_cell_list(row, col) -> None:
+                Starts a new cell list at the end of the cell buffer.
+            end_cell_list() -> None:
+                Keeps the current cell list if it has more than one cell.
+            reverse_cell_list() -> None:
+                Reverses the order of the cells in the current cell list.
+            investigate_row_col(row, col, investigate_all: bool=False) -> None:
                 Investigates a cell, then investigates any adjacent cells under appropriate conditions
             row_col_array_to_midpoint_coordinates(row_col_array)-> None:
                 Coverts the cell (row, col) to its midpoint coordinates.
@@ -80,18 +90,25 @@ class Vectorizer:
         self.bounds = basin_data.basin_probability.rio.bounds()
         self.x_res, self.y_res = np.abs(basin_data.basin_probability.rio.resolution())
         self.reference_waterway_data = reference_waterway_data
-        self.thin_grid = thin_grid.copy()
+        self.thin_grid = thin_grid
         self.connecting_points_coordinates = self.make_connecting_points_coordinates()
-        self.list_of_cell_lists = []
         self.line_strings = []
         self.new_linestrings = []
         self.intersection_points = []
-        self.connections_seen = defaultdict(set)
-        self.thin_grid[thin_grid == 2] = 0
-        self.clean_embed = self.embed_in_larger(grid=self.thin_grid, side_increase=1)
+        self.clean_embed = self.embed_in_larger(grid=thin_grid, side_increase=1, where=thin_grid != 2)
+        self.thin_grid = self.clean_embed[1:-1, 1:-1]
         self.count_grid = self.make_count_8_grid(self.clean_embed)
         self.init_count_copy = self.count_grid.copy()
         self.init_count_grid = self.count_grid.copy()
+        self.connections_seen = np.zeros(self.count_grid.shape, dtype=np.uint8)
+        # Each investigated cell uses up a connection, and cell lists are only kept if they have at least as many
+        # investigated cells as starting cells, so the cell buffer never holds more than 3 times the connections.
+        num_connections = self.count_grid.sum(dtype=np.int64)//2
+        self.cell_buffer = np.zeros((3*num_connections + 2, 2), dtype=np.int32)
+        self.cell_buffer_end = 0
+        self.line_offsets = [0]
+        self.count_1_buffer = np.zeros((2*num_connections + 2, 2), dtype=np.int32)
+        self.count_1_cells = []
         self.make_all_cell_lists()
         self.make_shapely_line_strings()
         self.connect_to_base_waterways()
@@ -112,22 +129,22 @@ class Vectorizer:
         reference_waterway_points = np.array(points)
         return reference_waterway_points
 
-    def make_connecting_points_coordinates(self) -> set:
+    def make_connecting_points_coordinates(self) -> np.ndarray:
+        """
+        Make the sorted coordinates for all cells that boarder the tdx waterways.
+        """
+        borders_tdx = maximum_filter((self.thin_grid == 2).astype(np.uint8), size=3, mode='constant') > 0
+        connecting_row_cols = np.argwhere((self.thin_grid == 1) & borders_tdx)
+        coords = self.row_col_array_to_midpoint_coordinates(connecting_row_cols)
+        return np.sort(self.coordinates_to_complex(coords))
+
+    @staticmethod
+    def coordinates_to_complex(coordinates: np.ndarray) -> np.ndarray:
         """
-        Make the set of coordinates for all cells that boarder the tdx waterways.
+        Converts an (n, 2) array of coordinates to n complex numbers x + y*1j, so that coordinates can be compared
+        with np.isin.
         """
-        rows, cols = np.where(self.thin_grid == 1)
-        connecting_row_cols = []
-        connecting_points = set()
-        rows_cols = zip(rows, cols)
-        for (row, col) in rows_cols:
-            if np.any(self.thin_grid[row-1:row+2, col-1:col+2] == 2):
-                connecting_row_cols.append((row, col))
-        connecting_row_cols = np.array(connecting_row_cols)
-        if len(connecting_row_cols) > 0:
-            coords = self.row_col_array_to_midpoint_coordinates(connecting_row_cols)
-            connecting_points.update([(x, y) for (x, y) in coords])
-        return connecting_points
+        return np.ascontiguousarray(coordinates, dtype=np.float64).view(np.complex128).ravel()
 
     @cached_property
     def connecting_lines(self) -> list[shapely.LineString]:
@@ -135,16 +152,14 @@ class Vectorizer:
         Makes a list of linestrings connecting the model's linestrings to the tdx linestrings.
         """
         if len(self.intersection_points) > 0:
-            connecting_points = shapely.points(self.intersection_points)
+            connecting_coordinates = np.array(self.intersection_points, dtype=np.float64).reshape(-1, 2)
             tree = shapely.STRtree(self.reference_waterway_points)
-            nearest_points = tree.query_nearest(geometry=connecting_points)
-            connecting_lines = shapely.linestrings(
-                [
-                    (connecting_points[i].coords[0], self.reference_waterway_points[j].coords[0])
-                    for i, j in zip(*nearest_points)
-                ]
-            )
-            self.intersection_points = [self.reference_waterway_points[j].coords[0] for i, j in zip(*nearest_points)]
+            point_indices, reference_indices = tree.query_nearest(geometry=shapely.points(connecting_coordinates))
+            reference_coordinates = shapely.get_coordinates(self.reference_waterway_points[reference_indices])
+            # An (n, 2, 2) array, line i goes from connecting point i to its nearest reference waterway point.
+            line_coordinates = np.stack([connecting_coordinates[point_indices], reference_coordinates], axis=1)
+            connecting_lines = shapely.linestrings(line_coordinates)
+            self.intersection_points = list(map(tuple, reference_coordinates.tolist()))
             return list(connecting_lines)
         return []
 
@@ -169,41 +184,46 @@ class Vectorizer:
         """
         Determines the points for the models waterways which will be connected to the tdx-waterways.
         """
-        new_linestrings = []
-        for line_string in self.line_strings:
-            coords_list = line_string.coords
-            head_coords = tuple(coords_list[0])
-            tail_coords = tuple(coords_list[-1])
-            if head_coords in self.connecting_points_coordinates and tail_coords in self.connecting_points_coordinates:
-                # If the waterway forms a closed loop with the tdx waterways, we ignore it.
-                continue
-            else:
-                new_linestrings.append(line_string)
-                if head_coords in self.connecting_points_coordinates:
-                    self.intersection_points.append(head_coords)
-                elif tail_coords in self.connecting_points_coordinates:
-                    self.intersection_points.append(tail_coords)
-                else:
-                    # If neither the head nor tail boarders a tdx waterway, check if any of other points do.
-                    for coords in coords_list:
-                        if coords in self.connecting_points_coordinates:
-                            self.intersection_points.append(coords)
-                            break
+        line_strings = np.array(self.line_strings, dtype=object)
+        coordinates, line_indices = shapely.get_coordinates(line_strings, return_index=True)
+        is_connecting = np.isin(self.coordinates_to_complex(coordinates), self.connecting_points_coordinates)
+        num_coordinates = np.bincount(line_indices, minlength=len(line_strings))
+        tail_indices = np.cumsum(num_coordinates) - 1
+        head_indices = tail_indices - num_coordinates + 1
+        head_connecting = is_connecting[head_indices]
+        tail_connecting = is_connecting[tail_indices]
+        # The index of the first coordinate of each waterway that boarders a tdx waterway, this is the head if the head
+        # boarders a tdx waterway.
+        connecting_lines, first_connecting = np.unique(line_indices[is_connecting], return_index=True)
+        first_connecting_indices = np.full(len(line_strings), -1)
+        first_connecting_indices[connecting_lines] = np.flatnonzero(is_connecting)[first_connecting]
+        # If the waterway forms a closed loop with the tdx waterways, we ignore it.
+        keep = ~(head_connecting & tail_connecting)
+        new_linestrings = list(line_strings[keep])
+        # Connect the waterway at its head if that boarders a tdx waterway, then the tail, and if neither the head nor
+        # tail boarders a tdx waterway, the first of the other points that does.
+        intersection_indices = np.where(
+            tail_connecting & ~head_connecting, tail_indices, first_connecting_indices
+        )[keep]
+        intersection_indices = intersection_indices[intersection_indices >= 0]
+        self.intersection_points += [tuple(point) for point in coordinates[intersection_indices].tolist()]
         new_linestrings += self.connecting_lines
         self.new_linestrings = new_linestrings
 
     @staticmethod
-    def embed_in_larger(grid: np.ndarray, side_increase: int) -> np.ndarray:
+    def embed_in_larger(grid: np.ndarray, side_increase: int, where: np.ndarray = None) -> np.ndarray:
         """
         embeds the grid in a larger grid for convince. We will look at sub-grids grid[row-1:row+2, col-1:col+2],
          and in the embedded grid we will always have 1<=row<=old_num_rows, 1<=col<=old_num_col, so we never go out of
-          bounds in the embedded grid.
+          bounds in the embedded grid. If where is given, only the cells of grid where it is True are copied, the rest
+          are 0.
         """
         num_rows, num_cols = grid.shape
         num_rows += 2*side_increase
         num_cols += 2*side_increase
         copy = np.zeros((num_rows, num_cols), dtype=grid.dtype)
-        copy[side_increase:-side_increase, side_increase:-side_increase] = grid
+        where = True if where is None else where
+        np.copyto(copy[side_increase:-side_increase, side_increase:-side_increase], grid, where=where)
         return copy
 
     @staticmethod
@@ -211,22 +231,18 @@ class Vectorizer:
         """
         Makes a grid whose cells are the number of neighboring cells that are waterways. 'count_8' for 8 connectivity.
         """
-        grid = grid.copy()
-        grid[grid > 0] = 1
-        count_grid = np.zeros(grid.shape, dtype=np.int16)
-        rows, cols = np.where(grid == 1)
-        for row, col in zip(rows, cols):
-            count_grid[row, col] = grid[row - 1:row + 2, col - 1:col + 2].sum() - 1
-        count_grid = count_grid
+        grid = (grid > 0).astype(np.int16)
+        neighbors = np.ones((3, 3), dtype=np.int16)
+        neighbors[1, 1] = 0
+        count_grid = convolve(grid, neighbors, mode='constant', cval=0)
+        count_grid *= grid
         return count_grid
 
     def make_all_cell_lists(self) -> None:
-        """Updates list_of_cell_lists which will be used to make line strings"""
-        while np.any(self.count_grid == 1):
-            self.make_all_cell_lists_starting_at_1()
+        """Updates the cell lists which will be used to make line strings"""
+        self.make_all_cell_lists_starting_at_1()
         self.make_all_cell_lists_starting_at_2()
-        while np.any(self.count_grid == 1):
-            self.make_all_cell_lists_starting_at_1()
+        self.make_all_cell_lists_starting_at_1()
         self.add_remaining_cell_lists()
 
     def add_remaining_cell_lists(self) -> None:
@@ -234,18 +250,26 @@ class Vectorizer:
         while np.any(self.count_grid > 0):
             rows, cols = np.where(self.count_grid >= 1)
             for row, col in zip(rows, cols):
-                cell_list = [(row, col)]
-                self.list_of_cell_lists.append(cell_list)
-                self.investigate_row_col(row, col, cell_list, True)
+                self.start_cell_list(row, col)
+                self.investigate_row_col(row, col, True)
+                self.end_cell_list()
 
     def make_all_cell_lists_starting_at_1(self, investigate_all: bool = False) -> None:
-        """Investigate all cells that boarder only one other cell (these should be sources or targets of waterways)"""
+        """
+        Investigate all cells that boarder only one other cell (these should be sources or targets of waterways).
+        Investigating cells can leave other cells bordering only one other cell, those are investigated next, until no
+        cells border only one other cell.
+        """
         rows, cols = np.where(self.count_grid == 1)
-        for row, col in zip(rows, cols):
-            if self.count_grid[row, col] == 1:
-                cell_list = [(row, col)]
-                self.list_of_cell_lists.append(cell_list)
-                self.investigate_row_col(row, col, cell_list, investigate_all)
+        cells = list(zip(rows, cols))
+        while len(cells) > 0:
+            self.count_1_cells = []
+            for row, col in cells:
+                if self.count_grid[row, col] == 1:
+                    self.start_cell_list(row, col)
+                    self.investigate_row_col(row, col, investigate_all)
+                    self.end_cell_list()
+            cells = sorted({cell for cell in self.count_1_cells if self.count_grid[cell] == 1})
 
     def make_all_cell_lists_starting_at_2(self, ignore_init: bool = False) -> None:
         """Investigate all cells that boarder two other cells (so somewhere in the middle of a waterway)"""
@@ -254,65 +278,64 @@ class Vectorizer:
         else:
             rows, cols = np.where((self.count_grid == 2) & (self.init_count_grid == 2))
         for row, col in zip(rows, cols):
-            cell_list = [(row, col)]
+            self.start_cell_list(row, col)
             if self.count_grid[row, col] > 0:
-                self.investigate_row_col(row, col, cell_list)
+                self.investigate_row_col(row, col)
             if self.count_grid[row, col] > 0:
-                cell_list.reverse()
-                self.investigate_row_col(row, col, cell_list)
-            if len(cell_list) > 1:
-                self.list_of_cell_lists.append(cell_list)
+                self.reverse_cell_list()
+                self.investigate_row_col(row, col)
+            self.end_cell_list()
+
+    def start_cell_list(self, row: int, col: int) -> None:
+        """Starts a new cell list at the end of the cell buffer, beginning with the cell (row, col)."""
+        self.cell_buffer[self.cell_buffer_end] = row, col
+        self.cell_buffer_end += 1
 
-    def add_to_connections_seen(self, node1: (int, int), node2: (int, int)) -> None:
+    def end_cell_list(self) -> None:
         """
-        adds nodes to a dictionary of sets of connections seen. Used so that we don't turn around while investigating
-        a cell.
+        Keeps the current cell list if it has more than one cell, otherwise we can't make a line string from it, and
+        its cells are dropped from the cell buffer.
         """
-        self.connections_seen[node1].add(node2)
-        self.connections_seen[node2].add(node1)
-
-    def investigate_row_col(
-            self, row: int, col: int, cell_list: list[(int, int)], investigate_all: bool = False
-    ) -> None:
-        """Investigates a cell, then investigates any adjacent cells under appropriate conditions"""
-        self.count_grid[row, col] -= 1
-        for i, j in [(1, 0), (-1, 0), (0, 1), (0, -1),
-                     (1, 1), (-1, 1), (1, -1), (-1, -1)]:
-            row1, col1 = row + i, col + j
-            if self.count_grid[row1, col1] > 0:
-                if (row1, col1) not in self.connections_seen[(row, col)]:
-                    self.add_to_connections_seen((row, col), (row1, col1))
-                    self.count_grid[row1, col1] -= 1
-                    if self.init_count_grid[row1, col1] == 1 and not investigate_all:
-                        cell_list.append((row1, col1))
-                    elif self.init_count_grid[row1, col1] == 2 and not investigate_all:
-                        cell_list.append((row1, col1))
-                        self.investigate_row_col(row1, col1, cell_list, investigate_all)
-                    else:
-                        cell_list.append((row1, col1))
-                    break
+        if self.cell_buffer_end - self.line_offsets[-1] > 1:
+            self.line_offsets.append(self.cell_buffer_end)
         else:
-            # In this case there is only one cell in the list, so we can't make a line string from it. This can occur
-            # if the cell boarders the reference waterways, but no other model waterways cells.
-            cell_list.pop()
+            self.cell_buffer_end = self.line_offsets[-1]
+
+    def reverse_cell_list(self) -> None:
+        """Reverses the order of the cells in the current cell list."""
+        cell_list = self.cell_buffer[self.line_offsets[-1]:self.cell_buffer_end]
+        cell_list[:] = cell_list[::-1].copy()
+
+    def investigate_row_col(self, row: int, col: int, investigate_all: bool = False) -> None:
+        """
+        Investigates a cell, then investigates any adjacent cells under appropriate conditions. The investigated cells
+        are added to the end of the current cell list.
+        """
+        num_cells, num_count_1 = investigate_row_col(
+            row, col, self.count_grid, self.init_count_grid, self.connections_seen, investigate_all,
+            self.cell_buffer[self.cell_buffer_end:], self.count_1_buffer
+        )
+        self.count_1_cells.extend(map(tuple, self.count_1_buffer[:num_count_1].tolist()))
+        if num_cells >= 0:
+            self.cell_buffer_end += num_cells
+        elif self.cell_buffer_end > self.line_offsets[-1]:
+            self.cell_buffer_end -= 1
 
     def row_col_array_to_midpoint_coordinates(self, row_col_array) -> np.ndarray:
-        x_resolution = self.x_res
-        y_resolution = np.abs(self.y_res)
+        # x_res and y_res are made non-negative in __init__.
         x_min, _, _, y_max = self.bounds
-        x_y_array = np.zeros(row_col_array.shape)
-        x_y_array[:, 0] = x_min + x_resolution*(row_col_array[:, 1] + .5)
-        x_y_array[:, 1] = y_max - y_resolution*(row_col_array[:, 0] + .5)
-        return x_y_array
+        x = x_min + self.x_res*(row_col_array[:, 1] + .5)
+        y = y_max - self.y_res*(row_col_array[:, 0] + .5)
+        return np.stack([x, y], axis=1)
 
     def make_shapely_line_strings(self) -> None:
-        for row_col_list in self.list_of_cell_lists:
-            # We have to decrease by 1 because row,col are from the embedded grid.
-            row_col_array = np.array(row_col_list) - 1
-            if len(row_col_array) > 1:
-                midpoint_coordinates = self.row_col_array_to_midpoint_coordinates(row_col_array)
-                self.line_strings.append(shapely.LineString(midpoint_coordinates))
-        self.line_strings = shapely.line_merge(shapely.MultiLineString(self.line_strings))
+        # We have to decrease by 1 because row,col are from the embedded grid.
+        row_col_array = self.cell_buffer[:self.line_offsets[-1]] - 1
+        midpoint_coordinates = self.row_col_array_to_midpoint_coordinates(row_col_array)
+        line_lengths = np.diff(self.line_offsets)
+        line_indices = np.repeat(np.arange(len(line_lengths)), line_lengths)
+        line_strings = shapely.linestrings(midpoint_coordinates, indices=line_indices)
+        self.line_strings = shapely.line_merge(shapely.multilinestrings(line_strings))
         self.line_strings = shapely.node(self.line_strings)
         if hasattr(self.line_strings, 'geoms'):
             self.line_strings = list(self.line_strings.geoms)